@@ -4,41 +4,225 @@
 
 It requires a classes database that can be built with indexer.py
 """
-import argparse
-import gzip
+import hashlib
 import json
 import logging
+import mmap
 import os.path
+import pickle
+import re
+import sqlite3
 import subprocess
+from typing import Iterator, Optional
+
+# Optional accelerators, fall back to the standard library.
+try:
+    from isal import igzip as gzip
+except ImportError:
+    import gzip  # type: ignore[no-redef]
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads  # type: ignore[assignment]
 
 logger = logging.getLogger(__name__)
 
+# Bump this whenever the layout of the pickled cache changes.
+CACHE_VERSION = 4
+# Layout of the database written by indexer.py, see indexer.DB_VERSION.
+DB_VERSION = 1
+# Where the source files of a target are cached between runs.
+CQUERY_CACHE_DIR = "~/.cache/autodeps/cquery-cache"
+
+
+# Matches import statements, like "import com.foo.Bar", "import static
+# com.foo.Bar.baz;", "import static com.foo.Bar.*;" and "import
+# com.foo.{A, B}". A statement starts a line or follows a ";", and may
+# be followed by a comment. The groups are "static", the imported name,
+# ".*" and the list of classes inside the braces.
+_IMPORT_RE = re.compile(
+    rb"(?:^|;)[ \t]*import[ \t]+(static[ \t]+)?([\w.$]+?)(\.\*)?"
+    rb"(?:\.\{([^}]*)\}|(?=[ \t]*(?:[;\r]|//|/\*|$)))", re.M)
+
+
+def _is_class_name(target):
+    return "." in target and not ":" in target
+
+
+def normalize_label(target):
+    """Expand //foo to //foo:foo, the way bazel reports rule names."""
+    if target.startswith("@//"):
+        target = target[1:]
+    if target.startswith("//") and ":" not in target:
+        target += ":" + target.rsplit("/", 1)[-1]
+    return target
+
+
+def find_workspace(path):
+    """Return the root of the bazel workspace containing path, or None."""
+    while True:
+        for f in ("MODULE.bazel", "WORKSPACE", "WORKSPACE.bazel"):
+            if os.path.exists(os.path.join(path, f)):
+                return path
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def package_tree_stamp(package_dir):
+    """Hash the mtimes of the directories of a package.
+
+    Adding or removing a file changes the mtime of the directory it is
+    in, at any depth, which is what globs like src/**/*.java see.
+    Subpackages are left out, their files belong to another package.
+    """
+    digest = hashlib.sha1()
+    stack = [package_dir]
+    while stack:
+        d = stack.pop()
+        try:
+            mtime = os.stat(d).st_mtime
+            with os.scandir(d) as it:
+                entries = list(it)
+        except OSError:
+            continue
+        if d != package_dir and any(e.name in ("BUILD", "BUILD.bazel") for e in entries):
+            continue
+        digest.update("{}\0{}\0".format(d, mtime).encode())
+        stack.extend(sorted(e.path for e in entries if e.is_dir(follow_symlinks=False)))
+    return digest.hexdigest()
+
+
+def read_db_file(db_file):
+    """Return the decompressed content of the database.
+
+    Files ending with .zst are Zstandard compressed, anything else is
+    read as gzip.
+    """
+    if db_file.endswith(".zst"):
+        import zstandard
+        with open(db_file, "rb") as fp:
+            return zstandard.ZstdDecompressor().stream_reader(fp).readall()
+    with gzip.open(db_file, "rb") as fp:
+        return fp.read()
+
 
 class AutoDeps(object):
-    def __init__(self, db_file):
-        with gzip.open(db_file, "rt") as fp:
-            db = json.load(fp)
+    # Annotated so `mypyc autodeps.py` can compile the lookups to C.
+    conn: Optional[sqlite3.Connection]
+    alias: dict[str, str]
+    rule_to_alias: dict[str, str]
+    rule_names: list[str]
+    # The rules are stored as indexes into rule_names.
+    class_to_rule: dict[str, list[int]]
+
+    def __init__(self, db_file: str) -> None:
+        # Connection to the SQLite database, None for the JSON database.
+        self.conn = None
+        if db_file.endswith(".sqlite"):
+            # Lookups are answered by the indexes, nothing to load.
+            # Read only, so a missing database is an error rather than
+            # a new empty file.
+            self.conn = sqlite3.connect("file:{}?mode=ro".format(db_file), uri=True)
+            self._check_db_version(
+                db_file, self.conn.execute("PRAGMA user_version").fetchone()[0])
+            return
+        cache_file = db_file + ".pkl"
+        if not self._load_cache(db_file, cache_file):
+            self._load_db(db_file)
+            self._save_cache(cache_file)
+
+    def _load_cache(self, db_file, cache_file):
+        """Load the pickled snapshot of the database if it is up to date."""
+        try:
+            if os.stat(cache_file).st_mtime < os.stat(db_file).st_mtime:
+                return False
+            with open(cache_file, "rb") as fp:
+                cache = pickle.load(fp)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return False
+        if cache[0] != CACHE_VERSION:
+            return False
+        (_, self.alias, self.rule_to_alias, self.rule_names,
+         self.class_to_rule) = cache
+        return True
+
+    def _save_cache(self, cache_file):
+        tmp_file = cache_file + ".tmp"
+        try:
+            with open(tmp_file, "wb") as fp:
+                pickle.dump((CACHE_VERSION, self.alias, self.rule_to_alias,
+                             self.rule_names, self.class_to_rule), fp, protocol=5)
+            os.replace(tmp_file, cache_file)
+        except OSError as e:
+            logger.warning("Unable to write cache %s: %s", cache_file, e)
+
+    def _load_db(self, db_file: str) -> None:
+        # Parse from bytes to skip the text decoder.
+        db = json_loads(read_db_file(db_file))
+        self._check_db_version(db_file, db.get("version"))
         self.alias = db["alias"]
         # Reverse mapping from a rule to the possible alias
         self.rule_to_alias = dict()
         for a, r in self.alias.items():
             self.rule_to_alias[r] = a
-        self.rules = db["jvm_libs"]
-        self.class_to_rule = dict()
-        for rule in self.rules.values():
-            name = rule[0]
-            classes = rule[4]
-            for c in classes:
-                if c in self.class_to_rule:
-                    self.class_to_rule[c].append(name)
-                    continue
-                    logger.warning("Duplicate class detected: %s, in %s and %s",
-                                   c, self.class_to_rule[c], name)
+        # Precomputed by the indexer.
+        self.rule_names = db["jvm_libs"]["names"]
+        self.class_to_rule = db["class_to_rule"]
 
-                else:
-                    self.class_to_rule[c] = [name]
+    def _check_db_version(self, db_file, version):
+        if version != DB_VERSION:
+            raise ValueError(
+                "{} was written by another version of indexer.py(layout {}, expected {}), "
+                "rebuild it with indexer.py".format(db_file, version, DB_VERSION))
 
     def _get_sources(self, target):
+        """Get the source files of target, cached until its package changes."""
+        stamp = self._get_package_stamp(target)
+        if stamp is None:
+            return list(self._query_sources(target))
+        cache_file = os.path.join(
+            os.path.expanduser(CQUERY_CACHE_DIR),
+            hashlib.sha1(stamp[0].encode() + target.encode()).hexdigest() + ".json")
+        try:
+            with open(cache_file, "r") as fp:
+                cache = json.load(fp)
+            if cache["stamp"] == stamp and all(map(os.path.exists, cache["sources"])):
+                return cache["sources"]
+        except (OSError, ValueError, KeyError):
+            pass
+        sources = list(self._query_sources(target))
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            with open(cache_file, "w") as fp:
+                json.dump(dict(target=target, stamp=stamp, sources=sources), fp)
+        except OSError as e:
+            logger.warning("Unable to write cache %s: %s", cache_file, e)
+        return sources
+
+    def _get_package_stamp(self, target):
+        """Return what invalidates the cached sources of target.
+
+        That is the workspace plus the mtime of the BUILD file and a
+        hash of the mtimes of the package directories(files added or
+        removed for globs), or None if the package can't be located.
+        """
+        if not target.startswith("//"):
+            return None
+        workspace = find_workspace(os.getcwd())
+        if workspace is None:
+            return None
+        package_dir = os.path.join(workspace, target[2:].partition(":")[0])
+        for build in ("BUILD.bazel", "BUILD"):
+            try:
+                build_mtime = os.stat(os.path.join(package_dir, build)).st_mtime
+            except OSError:
+                continue
+            return [workspace, build_mtime, package_tree_stamp(package_dir)]
+        return None
+
+    def _query_sources(self, target):
         output = subprocess.check_output(
             ['bazel', 'cquery', '--output=jsonproto',
              'labels(srcs, {})'.format(target)],
@@ -48,32 +232,85 @@ class AutoDeps(object):
             target = item["target"]
             if target["type"] == "SOURCE_FILE":
                 f = target["sourceFile"]["location"]
-                yield f.split(':')[0]
-
-    def _get_imports_from_file(self, fname):
-        with open(fname, "r") as fp:
-            for line in fp.readlines():
-                if line.startswith("import "):
-                    tokens = line.strip().split(maxsplit=1)
-                    class_name = tokens[1]
-                    if "{" in class_name:
+                yield f.partition(':')[0]
+
+    def _query_sources_many(self, targets):
+        """Get the source files of each of the targets with one cquery.
+
+        The rules are queried together with their srcs, the srcs
+        attribute of each rule is then mapped to the source file
+        locations.
+        """
+        expr = " + ".join(targets)
+        output = subprocess.check_output(
+            ['bazel', 'cquery', '--output=jsonproto',
+             # srcs is the only attribute of the rules we read.
+             '--proto:output_rule_attrs=srcs',
+             '{0} + labels(srcs, {0})'.format(expr)],
+            universal_newlines=True)
+        locations = dict()
+        rule_srcs = dict()
+        for item in json.loads(output).get("results", []):
+            target = item["target"]
+            if target["type"] == "SOURCE_FILE":
+                f = target["sourceFile"]
+                locations[f["name"]] = f["location"].partition(':')[0]
+            elif target["type"] == "RULE":
+                rule = target["rule"]
+                for attr in rule.get("attribute", []):
+                    if attr["name"] == "srcs":
+                        rule_srcs[rule["name"]] = attr.get("stringListValue", [])
+        sources = dict()
+        for target in targets:
+            srcs = rule_srcs.get(normalize_label(target), [])
+            sources[target] = [locations[s] for s in srcs if s in locations]
+        return sources
+
+    def _get_imports_from_file(self, fname: str) -> Iterator[str]:
+        with open(fname, "rb") as fp:
+            try:
+                buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty file
+                return
+            with buf:
+                for m in _IMPORT_RE.finditer(buf):
+                    class_name = m[2].decode()
+                    if m[1] is not None:
+                        # The class of the member, or of all its members.
+                        yield class_name if m[3] else class_name.rpartition(".")[0]
+                    elif m[4] is not None:
                         # Deal with multiple imports, like import com.foo.bar.{A, B}
-                        parts = class_name.split("{")
-                        more_classes = parts[1].rstrip("}").split(",")
-                        for i in more_classes:
-                            yield parts[0] + i.strip()
-                    else:
+                        for i in m[4].decode().split(","):
+                            yield class_name + "." + i.strip()
+                    elif m[3] is None:
+                        # Wildcard imports of a package(import com.foo.*)
+                        # name no class, they are skipped.
                         yield class_name
 
-    def _find_bazel_rule_for_class(self, c):
+    def _find_bazel_rule_for_class(self, c: str) -> list[str]:
+        if self.conn is not None:
+            row = self.conn.execute(
+                "SELECT rules FROM class_to_rule WHERE class=?", (c,)).fetchone()
+            return json_loads(row[0]) if row else []
         if c in self.class_to_rule:
-            return self.class_to_rule[c]
+            return [self.rule_names[r] for r in self.class_to_rule[c]]
         return []
 
-    def _maybe_get_classes(self, target):
-        if "." in target and not ":" in target:
+    def _get_alias(self, rule: str) -> str:
+        """Return the alias of the rule, or the rule itself if there is none."""
+        if self.conn is not None:
+            row = self.conn.execute(
+                "SELECT alias FROM alias WHERE rule=?", (rule,)).fetchone()
+            return row[0] if row else rule
+        return self.rule_to_alias.get(rule, rule)
+
+    def _maybe_get_classes(self, target: str) -> set[str]:
+        if _is_class_name(target):
             return set([target])
-        src_files = list(self._get_sources(target))
+        return self._get_classes_from_sources(self._get_sources(target))
+
+    def _get_classes_from_sources(self, src_files: list[str]) -> set[str]:
         logger.info("Get sources %s", src_files)
         all_classes = set()
         for src in src_files:
@@ -94,7 +331,25 @@ class AutoDeps(object):
         4. Merge all the resolved targets.
         5. Replace the target name with their alias if alias is set.
         """
-        all_classes = self._maybe_get_classes(target)
+        self._print_deps(self._maybe_get_classes(target))
+
+    def resolve_many(self, targets):
+        """Resolve dependencies for each of the given targets.
+
+        Same as resolve(), but the source files of all the bazel
+        targets are fetched with a single cquery.
+        """
+        rules = [t for t in targets if not _is_class_name(t)]
+        sources = self._query_sources_many(rules) if rules else dict()
+        for target in targets:
+            print("## {}".format(target))
+            if target in sources:
+                all_classes = self._get_classes_from_sources(sources[target])
+            else:
+                all_classes = set([target])
+            self._print_deps(all_classes)
+
+    def _print_deps(self, all_classes):
         logger.info("classes %s", all_classes)
         # rule_name(that provides class) -> list of classes that need this rule.
         deps = dict()
@@ -105,35 +360,44 @@ class AutoDeps(object):
                 else:
                     deps[d] = [c]
         # Check exports to find the right deps.
-        import pdb
-        # pdb.set_trace()
         for d, classes in sorted(deps.items()):
-            if d in self.rule_to_alias:
-                d = self.rule_to_alias[d]
+            d = self._get_alias(d)
             print("# {}".format(" ".join(classes)))
             print('"{}",'.format(d))
 
 
 def main():
+    # Only needed for the command line, not when used as a library.
+    import argparse
+
     parser = argparse.ArgumentParser(
-        formatter_class=argparse.ArgumentDefaultsHelpFormatter, description=__doc__
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        # Not __doc__ directly, it is None once compiled by mypyc.
+        description=globals()["__doc__"]
     )
     parser.add_argument(
         "target",
         type=str,
+        nargs="+",
         default="//common:common",
-        help="Which bazel target(//foo:bar) or class(com.foo.Bar) to process."
+        help="Which bazel target(s)(//foo:bar) or class(com.foo.Bar) to process."
     )
     parser.add_argument(
         "--db",
         type=str,
         default="~/.cache/autodeps/autodeps-db.json.gz",
-        help="Database used by autodeps",
+        help="Database used by autodeps(.json.gz, .json.zst or .sqlite)",
     )
 
     args = parser.parse_args()
-    a = AutoDeps(os.path.expanduser(args.db))
-    a.resolve(args.target)
+    try:
+        a = AutoDeps(os.path.expanduser(args.db))
+    except ValueError as e:
+        parser.exit(1, "{}\n".format(e))
+    if len(args.target) == 1:
+        a.resolve(args.target[0])
+    else:
+        a.resolve_many(args.target)
 
 
 if __name__ == "__main__":
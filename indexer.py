@@ -2,54 +2,237 @@
 
 """Prototype auto deps."""
 
-import argparse
 import collections
+import concurrent.futures
 import gzip
 import json
 import logging
+import mmap
 import subprocess
 import os
+import re
+import shutil
+import sqlite3
+import struct
+import sys
 import zipfile
+from typing import TypedDict
+
+# orjson is optional, it parses and serializes several times faster.
+try:
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode()
+
+# msgspec is optional, it decodes the targets straight to the fields
+# parse() reads, without building the rest of the proto.
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+# ijson is optional, used to parse --seed-file incrementally.
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 
 logger = logging.getLogger(__name__)
 
+# Layout of the database, bump it together with autodeps.DB_VERSION
+# whenever what to_json or to_sqlite write changes.
+DB_VERSION = 1
+
+# Rules that should be skipped
+RULE_SKIP_LIST = frozenset([
+    # Compile time only dependencies, only used for debezium
+    "@debezium_1_7//:compile_time_only_dependencies",
+])
+
 
 # Represent any kind of JVM like library, like java_import,
 # generic_scala_worker. The jar should be pointed to either ijar or
 # the deploy jar(for library), which contains the list of class files.
-class JvmLib(collections.namedtuple("JvmLib", [
-        "name", "jars", "exports", "visibility", "classes"])):
+class JvmLib(object):
+    __slots__ = ("name", "jars", "exports", "visibility", "classes")
+
+    def __init__(self, name, jars, exports, visibility, classes):
+        self.name = name
+        self.jars = jars
+        self.exports = exports
+        self.visibility = visibility
+        self.classes = classes
+
+    def __repr__(self):
+        return "JvmLib(name={!r}, jars={!r})".format(self.name, self.jars)
 
     def add_class(self, c):
         self.classes.append(c)
 
+    def to_list(self, class_names):
+        """Fields in the order used by the database.
+
+        self.classes holds ids, class_names maps them back to the names.
+        """
+        return [self.name, self.jars, self.exports, self.visibility,
+                [class_names[c] for c in self.classes]]
+
+
+# Rule attributes we care about: attribute name -> (key in the dict
+# returned by build_attributes_dict, field holding the value).
+_ATTRIBUTES = {
+    "actual": ("actual", "stringValue"),
+    "visibility": ("visibility", "stringListValue"),
+    "exports": ("exports", "stringListValue"),
+    "srcs": ("src", "stringListValue"),
+    "jars": ("jars", "stringListValue"),
+    "emit_ijar": ("emit_ijar", "stringValue"),
+}
+
 
 def build_attributes_dict(rule):
     ret = {}
     for item in rule["attribute"]:
-        if item["name"] == "actual":
-            ret["actual"] = item["stringValue"]
-        elif item["name"] == "visibility" and "stringListValue" in item:
-            ret["visibility"] = item["stringListValue"]
-        elif item["name"] == "exports" and "stringListValue" in item:
-            ret["exports"] = item["stringListValue"]
-        elif item["name"] == "srcs" and "stringListValue" in item:
-            ret["src"] = item["stringListValue"]
-        elif item["name"] == "jars" and "stringListValue" in item:
-            ret["jars"] = item["stringListValue"]
-        elif item["name"] == "emit_ijar" and "stringValue" in item:
-            ret["emit_ijar"] = item["stringValue"] == "true"
-
+        h = _ATTRIBUTES.get(item["name"])
+        if h and h[1] in item:
+            ret[h[0]] = item[h[1]]
+    if "emit_ijar" in ret:
+        ret["emit_ijar"] = ret["emit_ijar"] == "true"
     return ret
 
 
+# Layout of the zip end of central directory record and central
+# directory file header, see APPNOTE.TXT from PKWARE.
+_EOCD_SIGNATURE = b"PK\x05\x06"
+_EOCD = struct.Struct("<4s4H2LH")
+_CD_SIGNATURE = 0x02014b50
+_CD_SIGNATURE_BYTES = b"PK\x01\x02"
+# Right before the EOCD of zip64 archives.
+_ZIP64_LOCATOR_SIGNATURE = b"PK\x06\x07"
+# Only the signature, the flags and the name, extra and comment lengths
+# of a central directory header are needed.
+_CD_HEADER = struct.Struct("<I4xH18x3H12x")
+# The EOCD is at the end of the file, followed by a comment of at most 64 KiB.
+_EOCD_SEARCH_SIZE = _EOCD.size + 0xffff
+
+
+def _find_eocd(buf):
+    """Return the position of the end of central directory record, or -1.
+
+    The comment may contain the signature too, so the matches are
+    checked from the last one: the record must be preceded by a central
+    directory and followed by its comment. One whose comment ends the
+    file wins over one followed by trailing data.
+    """
+    search_start = max(0, len(buf) - _EOCD_SEARCH_SIZE)
+    eocd_pos = len(buf)
+    trailing_data_pos = -1
+    while True:
+        eocd_pos = buf.rfind(_EOCD_SIGNATURE, search_start, eocd_pos)
+        if eocd_pos < 0:
+            return trailing_data_pos
+        if eocd_pos + _EOCD.size > len(buf):
+            continue
+        (_, _, _, _, entries, cd_size, _, comment_len) = _EOCD.unpack_from(buf, eocd_pos)
+        end = eocd_pos + _EOCD.size + comment_len
+        # Archives with data prepended(like executable jars) shift the
+        # offsets, so locate the central directory relative to the EOCD.
+        cd_start = eocd_pos - cd_size
+        if end > len(buf) or cd_start < 0 or (
+                entries and buf[cd_start:cd_start + 4] != _CD_SIGNATURE_BYTES):
+            continue
+        if end == len(buf):
+            return eocd_pos
+        if trailing_data_pos < 0:
+            trailing_data_pos = eocd_pos
+
+
+def _read_central_directory_classes(buf):
+    """Get the class names of a zip from its central directory.
+
+    The suffix is checked on the raw bytes, so only the names of the
+    .class entries are ever decoded. Returns None if the archive is
+    something we don't handle here(zip64, multi disk, corrupted), so the
+    caller can fall back to zipfile.
+    """
+    eocd_pos = _find_eocd(buf)
+    if eocd_pos < 0:
+        return None
+    (_, disk, cd_disk, _, entries, cd_size, cd_offset,
+     _) = _EOCD.unpack_from(buf, eocd_pos)
+    if (disk != 0 or cd_disk != 0 or entries == 0xffff or cd_size == 0xffffffff
+            or cd_offset == 0xffffffff or buf[eocd_pos - 20:eocd_pos - 16] == _ZIP64_LOCATOR_SIGNATURE):
+        return None
+    # Copied once, so the suffix can be checked in place with
+    # bytes.endswith rather than slicing the mmap for every entry.
+    cd = buf[eocd_pos - cd_size:eocd_pos]
+    unpack_header = _CD_HEADER.unpack_from
+    offset = 0
+    classes = []
+    for _ in range(entries):
+        if offset + _CD_HEADER.size > cd_size:
+            return None
+        signature, flags, name_len, extra_len, comment_len = unpack_header(cd, offset)
+        if signature != _CD_SIGNATURE:
+            return None
+        start = offset + _CD_HEADER.size
+        end = start + name_len
+        if name_len >= 6 and cd.endswith(b".class", start, end):
+            name = cd[start:end - 6]
+            if not flags & 0x800 and extra_len and not name.isascii():
+                # Legacy encoded name which may carry the real UTF-8 name
+                # in an Info-ZIP unicode path extra field, rare enough to
+                # leave to zipfile.
+                return None
+            # "/" and "." are the same bytes in both encodings. Same as
+            # zipfile, bit 11 marks names encoded in UTF-8.
+            classes.append(name.replace(b"/", b".").decode(
+                "utf-8" if flags & 0x800 else "cp437"))
+        offset = end + extra_len + comment_len
+    return classes
+
+
 def get_class_names_from_jar(jar_file):
-    """Get list of classes from jar by listing the class names."""
-    with zipfile.ZipFile(jar_file) as zp:
-        for name in zp.namelist():
-            if name.endswith(".class"):
-                yield name.replace("/", ".").removesuffix(".class")
+    """Get list of classes from jar by listing the class names.
+
+    The central directory is read directly from a mmap of the jar,
+    which avoids building a ZipInfo for every entry.
+    """
+    with open(jar_file, "rb") as fp:
+        try:
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                classes = _read_central_directory_classes(buf)
+        except ValueError:
+            # Empty file, let zipfile report it.
+            classes = None
+        if classes is not None:
+            yield from classes
+            return
+        # Only the central directory is needed, never the local file
+        # headers. infolist() returns the list zipfile already holds,
+        # namelist() would build another one.
+        with zipfile.ZipFile(fp, mode="r", allowZip64=True) as zp:
+            for info in zp.infolist():
+                name = info.filename
+                if name.endswith(".class"):
+                    yield name.replace("/", ".").removesuffix(".class")
+
+
+def _list_classes_in_jar(jar_file):
+    """Picklable wrapper used by the worker processes of _scan_classes."""
+    return list(get_class_names_from_jar(jar_file))
+
+
+def normalize_label(label):
+    """Drop the main repository prefix, @@//foo:bar is //foo:bar."""
+    if label.startswith("@@//"):
+        return label[2:]
+    if label.startswith("@//"):
+        return label[1:]
+    return label
 
 
 class BazelWrapper(object):
@@ -57,9 +240,20 @@ class BazelWrapper(object):
     def __init__(self, workspace):
         # Workspace directory
         self.workspace = os.path.expanduser(workspace) if workspace else os.getcwd()
+        # Command whose output stream_output is reading, if any.
+        self._streaming = None
+
+    def _check_not_streaming(self, command):
+        # The bazel server runs one command at a time, a second one
+        # waits for the lock while the first waits for its output to
+        # be read.
+        if self._streaming:
+            raise RuntimeError("Running {} while reading the output of {} would deadlock".format(
+                " ".join(command), " ".join(self._streaming)))
 
     def build(self, *targets):
         command = ["bazel", "build"] + list(targets)
+        self._check_not_streaming(command)
         logger.info(" ".join(command))
         subprocess.check_call(["bazel", "build"] + list(targets),
                               cwd=self.workspace)
@@ -67,6 +261,7 @@ class BazelWrapper(object):
     def check_output(self, *args, **kwargs):
         """run bazel with the given args, return the output."""
         command = ["bazel"] + list(args)
+        self._check_not_streaming(command)
         logger.info("Running %s", " ".join(command))
         return subprocess.check_output(command, cwd=self.workspace,
                                        universal_newlines=True,
@@ -75,22 +270,62 @@ class BazelWrapper(object):
     def cquery(self, *args, **kwargs):
         return self.check_output("cquery", *args, **kwargs)
 
-    def get_deps_tree(self, target):
-        return self.cquery("--noimplicit_deps",
-                           "--output=jsonproto",
-                           "deps({})".format(target))
+    def stream_output(self, parse, *args):
+        """run bazel with the given args, yield from parse(stdout) while
+        it is running.
+
+        No other bazel command can be run until the output is consumed.
+        """
+        command = ["bazel"] + list(args)
+        self._check_not_streaming(command)
+        logger.info("Running %s", " ".join(command))
+        self._streaming = command
+        try:
+            with subprocess.Popen(command, cwd=self.workspace, stdout=subprocess.PIPE) as proc:
+                try:
+                    yield from parse(proc.stdout)
+                except Exception:
+                    # Likely output cut short by the failure, report that instead.
+                    if proc.wait() == 0:
+                        raise
+        finally:
+            self._streaming = None
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, command)
+
+    def get_deps_tree(self, target, use_query=False):
+        """Yield the targets in the deps of target as they are emitted.
+
+        The output is parsed while bazel writes it, so we don't hold
+        the whole of it in memory. cquery has no streamed_jsonproto
+        output, its jsonproto is parsed incrementally with ijson (read
+        at once without it). With use_query, bazel query and its
+        streamed_jsonproto output(one target per line, bazel 7+) are
+        used instead. It skips the analysis phase, but the attributes
+        set with select() are left out since they are not resolved.
+        """
+        if use_query:
+            command, output, parse = "query", "--output=streamed_jsonproto", iter_streamed_targets
+        else:
+            command, output, parse = "cquery", "--output=jsonproto", iter_jsonproto_targets
+        return self.stream_output(
+            parse, command, "--noimplicit_deps", output,
+            # Only the attributes build_attributes_dict reads.
+            "--proto:output_rule_attrs=" + ",".join(_ATTRIBUTES),
+            "deps({})".format(target))
 
     def get_info(self):
         output = self.check_output("info", "bazel-bin", "output_base")
         bazel_bin = None
         output_base = None
-        for line in output.split("\n"):
-            items = line.split(": ")
-            if len(items) == 2:
-                if items[0] == "bazel-bin":
-                    bazel_bin = items[1].strip()
-                elif items[0] == "output_base":
-                    output_base = items[1].strip()
+        for line in output.splitlines():
+            key, sep, value = line.partition(": ")
+            if not sep:
+                continue
+            if key == "bazel-bin":
+                bazel_bin = value.strip()
+            elif key == "output_base":
+                output_base = value.strip()
         return bazel_bin, output_base
 
     def get_sources(self, target):
@@ -105,61 +340,170 @@ class BazelWrapper(object):
                 target = item["target"]
                 if target["type"] == "SOURCE_FILE":
                     f = target["sourceFile"]["location"]
-                    yield f.split(':')[0]
+                    yield f.partition(':')[0]
 
-    def get_outputs(self, target, suffix=None):
-        """Get the outputs of the given target.
+    def get_outputs_many(self, targets, suffix=None):
+        """Get the outputs of each of the given targets with one cquery.
 
-        If suffix is not None, only return the file with the given
-        suffix.
+        Returns a dict from the target label to its outputs. If suffix is
+        not None, only return the files with the given suffix.
         """
-        expr = "'\\n'.join([f.path for f in target.files.to_list()])"
+        # One "label path" line per output, to tell the targets apart,
+        # which --output=files can't do.
+        expr = "'\\n'.join([str(target.label) + ' ' + f.path for f in target.files.to_list()])"
         cquery_output = self.cquery("--output=starlark",
                                     "--starlark:expr",
-                                    expr, target, stderr=subprocess.DEVNULL)
-        files = cquery_output.strip().split("\n")
-        if suffix:
-            return [x for x in files if x.endswith(suffix)]
-        else:
-            return files
+                                    expr, "set({})".format(" ".join(targets)),
+                                    stderr=subprocess.DEVNULL)
+        outputs = {normalize_label(t): [] for t in targets}
+        for line in cquery_output.splitlines():
+            label, _, path = line.partition(" ")
+            if path and (not suffix or path.endswith(suffix)):
+                outputs.setdefault(normalize_label(label), []).append(path)
+        return {t: outputs[normalize_label(t)] for t in targets}
 
 
 class DepsParser(object):
-    def __init__(self, bazel_wrapper):
+    def __init__(self, bazel_wrapper, jobs=None):
+        # Number of processes listing the jars, defaults to the number of CPUs.
+        self.jobs = jobs or os.cpu_count() or 1
         # Map from alias to the real target
         self.alias_map = dict()
         self.jvm_libs = dict()
         self.bazel = bazel_wrapper
         self.bazel_bin, self.output_base = self.bazel.get_info()
         self.skipped_rule_classes = set()
+        # Class name -> id, jars share most of their packages so the
+        # rules keep the ids rather than one copy of each name.
+        self._class_intern = dict()
+        # Id -> class name.
+        self._class_names = []
+        # java_import rules, their jars are checked once parsed.
+        self._java_imports = []
+        # Rules whose jars can only be known by querying their outputs.
+        self._needs_outputs = set()
+        # Rule class -> handler, other rule classes are skipped.
+        self._rule_handlers = {
+            "alias": self._parse_alias,
+            "generic_scala_worker": self._parse_scala_worker,
+            "java_library": self._parse_java_library,
+            "java_import": self._parse_java_import,
+            "scala_proto_library": self._parse_jar_generators,
+            "jarjar_links": self._parse_jar_generators,
+        }
         logger.info("bazel-bin: %s, output_base: %s", self.bazel_bin, self.output_base)
-
-    def parse(self, deps_json):
-        # Parse the list of jvm related rules
-        objs = json.loads(deps_json)
-        for t in objs["results"]:
-            target = t["target"]
+        self._reset_jar_lookup()
+
+    def _reset_jar_lookup(self):
+        """(Re)build what is known about the jars on disk, like after a build."""
+        # Directories to look for the jars, in order of preference.
+        self.jar_roots = [p for p in [self.bazel.workspace, self.output_base, self.bazel_bin]
+                          if p and os.path.isdir(p)]
+        # Memoized os.path.exists() of the candidate jar paths.
+        self._path_exists = dict()
+        # Top level directory of a relative jar path -> jar_roots
+        # reordered to start with the root it was last found in.
+        self._roots_by_top_dir = dict()
+        # Every jar under bazel-bin and the external repositories, found
+        # with one walk instead of a stat per candidate path. The
+        # workspace is not indexed, it is the whole source tree.
+        self._indexed_dirs = [p for p in [self.bazel_bin,
+                                          self.output_base and os.path.join(self.output_base, "external")]
+                              if p and os.path.isdir(p)]
+        # Walked on first use, so it includes what was built after the
+        # parser was created, like the seed target.
+        self._jar_index = None
+
+    def _get_jar_index(self):
+        if self._jar_index is None:
+            jar_index = set()
+            for d in self._indexed_dirs:
+                self._index_jars(d, jar_index)
+            logger.info("Found %d jars under %s", len(jar_index), self._indexed_dirs)
+            self._jar_index = jar_index
+        return self._jar_index
+
+    def _index_jars(self, directory, jar_index):
+        visited = set()
+        stack = [directory]
+        while stack:
+            d = stack.pop()
+            try:
+                it = os.scandir(d)
+            except OSError:
+                continue
+            with it:
+                for entry in it:
+                    if entry.name.endswith(".jar"):
+                        jar_index.add(entry.path)
+                    elif entry.name.endswith(".runfiles"):
+                        # Symlink forests to files indexed elsewhere.
+                        continue
+                    elif entry.is_dir():
+                        if entry.is_symlink():
+                            # Like external local repositories.
+                            real = os.path.realpath(entry.path)
+                            if real in visited:
+                                continue
+                            visited.add(real)
+                        stack.append(entry.path)
+
+    def _exists(self, path):
+        if path.endswith(".jar"):
+            for d in self._indexed_dirs:
+                if path.startswith(d + os.sep):
+                    return path in self._get_jar_index()
+        return os.path.exists(path)
+
+    def parse(self, targets):
+        """Parse the list of jvm related rules from an iterable of targets."""
+        for target in targets:
             if target["type"] != "RULE":
                 continue
             rule = target["rule"]
-            if rule["ruleClass"] == "alias":
-                attr = build_attributes_dict(rule)
-                a = rule["name"]
-                print("Alias {} -> {}".format(a, attr["actual"]))
-                self.alias_map[a] = attr["actual"]
-            elif rule["ruleClass"] == "generic_scala_worker":
-                self._parse_scala_worker(rule)
-            elif rule["ruleClass"] == "java_library":
-                self._parse_java_library(rule)
-            elif rule["ruleClass"] == "java_import":
-                self._parse_java_import(rule)
-            elif rule["ruleClass"] in ["scala_proto_library", "jarjar_links"]:
-                self._parse_jar_generators(rule)
+            if rule["name"] in RULE_SKIP_LIST:
+                logger.info("Skip %s", rule["name"])
+                continue
+            # Interned, the same few rule classes repeat for every target.
+            rule_class = sys.intern(rule["ruleClass"])
+            handler = self._rule_handlers.get(rule_class)
+            if handler:
+                handler(rule)
             else:
-                self.skipped_rule_classes.add(rule["ruleClass"])
+                self.skipped_rule_classes.add(rule_class)
+        # The handlers keep the jar labels, the candidate paths of all
+        # of them are checked at once here.
+        self._prefetch_paths(
+            self._jar_relative_path(jar) for rule in self.jvm_libs.values()
+            for jar in rule.jars)
+        for name in self._java_imports:
+            if any(self._guess_jar_full_path(jar) is None
+                   for jar in self.jvm_libs[name].jars):
+                # Use expensive query to get jar paths, batched in _resolve_outputs.
+                self._needs_outputs.add(name)
+        if self._needs_outputs:
+            self._resolve_outputs()
         # Get the list of classes from each rule
         self._scan_classes()
 
+    def _resolve_outputs(self):
+        """Get the jars of the rules that need their outputs queried.
+
+        These are queried all together, a cquery per rule costs bazel's
+        startup and query evaluation every time.
+        """
+        names = sorted(self._needs_outputs)
+        logger.info("Querying the outputs of %d rules", len(names))
+        for name, jars in self.bazel.get_outputs_many(names, suffix=".jar").items():
+            self.jvm_libs[name].jars = jars
+        self._needs_outputs.clear()
+
+    def _parse_alias(self, rule):
+        attr = build_attributes_dict(rule)
+        a = rule["name"]
+        print("Alias {} -> {}".format(a, attr["actual"]))
+        self.alias_map[a] = attr["actual"]
+
     def report(self):
         logger.info("Ignored these rule classes: %s", self.skipped_rule_classes)
 
@@ -181,9 +525,8 @@ class DepsParser(object):
                 if i.endswith("_deploy.jar"):
                     jar = i
                     break
-        jar = self._guess_jar_full_path(jar)
-
-        self.jvm_libs[name] = JvmLib(name, [jar], attr.get("exports", None),
+        self.jvm_libs[name] = JvmLib(name, self._guess_output_jars(jar),
+                                     attr.get("exports", None),
                                      attr.get("visibility", None), [])
 
     def _parse_jar_generators(self, rule):
@@ -196,8 +539,9 @@ class DepsParser(object):
         """
         name = rule["name"]
         attr = build_attributes_dict(rule)
-        jars = self.bazel.get_outputs(name, suffix=".jar")
-        self.jvm_libs[name] = JvmLib(name, jars, attr.get("exports", None),
+        # The jars are filled in by _resolve_outputs.
+        self._needs_outputs.add(name)
+        self.jvm_libs[name] = JvmLib(name, [], attr.get("exports", None),
                                      attr.get("visibility", None), [])
 
     def _parse_java_library(self, rule):
@@ -209,8 +553,8 @@ class DepsParser(object):
             if i.endswith(".jar") and not i.endswith("-src.jar"):
                 jar = i
                 break
-        jar = self._guess_jar_full_path(jar)
-        self.jvm_libs[name] = JvmLib(name, [jar], attr.get("exports", None),
+        self.jvm_libs[name] = JvmLib(name, self._guess_output_jars(jar),
+                                     attr.get("exports", None),
                                      attr.get("visibility", None), [])
 
     def _parse_java_import(self, rule):
@@ -218,88 +562,319 @@ class DepsParser(object):
         attr = build_attributes_dict(rule)
         jars = attr.get("jars", [])
         # The jars of java_import could be jar file in the source
-        # tree, or output from another rule.
-        resolved_jars = []
+        # tree, or output from another rule. parse() checks if the
+        # labels map to files, and queries the outputs of the rule
+        # otherwise.
         if jars:
-            # First we use basic transformation to get the full path
-            # of each jars.
-            for jar in jars:
-                full_path = self._guess_jar_full_path(jar)
-                if full_path:
-                    resolved_jars.append(full_path)
-        if len(resolved_jars) != len(jars) or len(jars) == 0:
-            # Use expensive query to get jar paths
-            resolved_jars = self.bazel.get_outputs(name, suffix=".jar")
+            self._java_imports.append(name)
+        else:
+            self._needs_outputs.add(name)
         self.jvm_libs[name] = JvmLib(
-            name, resolved_jars,
+            name, jars,
             attr.get("exports", None),
             attr.get("visibility", None), [])
 
     def _get_full_path_under_output(self, relative_path):
-        # logger.info("search %s", relative_path)
-        for prefix in [self.bazel.workspace, self.output_base, self.bazel_bin]:
+        # Paths under the same top level directory(like bazel-out or
+        # external) are nearly always found in the same root, try the
+        # root that matched last time first.
+        top = relative_path.partition("/")[0]
+        roots = self._roots_by_top_dir.get(top, self.jar_roots)
+        for prefix in roots:
             p = os.path.join(prefix, relative_path)
-            logger.info("check %s", p)
-            if os.path.exists(p):
+            logger.debug("check %s", p)
+            exists = self._path_exists.get(p)
+            if exists is None:
+                exists = self._path_exists[p] = self._exists(p)
+            if exists:
+                if prefix != roots[0]:
+                    self._roots_by_top_dir[top] = [prefix] + [
+                        r for r in self.jar_roots if r != prefix]
                 return p
         return None
 
-    def _guess_jar_full_path(self, jar):
-        # Start with basic transformation to get the jar location
+    def _prefetch_paths(self, relative_paths):
+        """Check the candidate paths of many jars at once.
+
+        The stat calls are issued from a thread pool, which keeps the
+        filesystem busy when the metadata is not cached.
+        """
+        paths = [os.path.join(prefix, r) for r in relative_paths for prefix in self.jar_roots]
+        paths = [p for p in dict.fromkeys(paths) if p not in self._path_exists]
+        if not paths:
+            return
+        # Walk the jars once here rather than from every thread.
+        self._get_jar_index()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=32) as executor:
+            self._path_exists.update(zip(paths, executor.map(self._exists, paths)))
+
+    def _jar_relative_path(self, jar):
+        """Map a jar label to its path relative to one of the jar roots."""
         if jar.startswith("//"):
             # This is a rule inside the current workspace
-            jar_relative_path = jar.removeprefix("//").replace(":", "/")
-            gp = self._get_full_path_under_output(jar_relative_path)
-            if gp:
-                return gp
+            return jar.removeprefix("//").replace(":", "/")
         elif jar.startswith("@"):
             # This is a rule from external repo, like '@scala_2_12//:lib/jline-2.14.6.jar'
-            gp = self._get_full_path_under_output(os.path.join("external", jar.removeprefix("@").replace("//:", "/").replace("//", "/").replace(":", "/")))
-            if gp:
-                return gp
-        elif jar.startswith("bazel-out"):
-            # These are the jars got from generators
-            gp = self._get_full_path_under_output(jar)
-            if gp:
-                return gp
-        return None
+            return os.path.join("external", jar.removeprefix("@").replace("//:", "/").replace("//", "/").replace(":", "/"))
+        # These are the jars got from generators, like bazel-out/...
+        return jar
+
+    def _guess_jar_full_path(self, jar):
+        return self._get_full_path_under_output(self._jar_relative_path(jar))
 
-    def _record_classes_from_rule(self, rule, jar):
-        # jar_file = self._get_jar_location(jar, rule.name)
-        # Some rule like java_import may have resolved the jar to full path already.
-        if os.path.isabs(jar):
+    def _guess_output_jars(self, jar):
+        """Get the jars list of a rule from its output jar label.
+
+        The label is mapped to a path by _scan_classes, which also
+        builds the jars that don't exist yet all at once.
+        """
+        if jar is None:
+            return []
+        return [jar]
+
+    def _get_jar_file(self, jar):
+        if os.path.isabs(jar) and not jar.startswith("//"):
+            # Some rule like java_import may have resolved the jar to full path already.
             jar_file = jar
         else:
-            jar_file = self._get_full_path_under_output(jar)
+            jar_file = self._guess_jar_full_path(jar)
         logger.info("jar is found in %s", jar_file)
-        for c in get_class_names_from_jar(jar_file):
-            rule.add_class(c)
+        return jar_file
+
+    def _resolve_missing_jars(self, rules):
+        """Build the rules whose jars are missing, with a single bazel build."""
+        logger.info("Building %d rules with missing jars", len(rules))
+        try:
+            self.bazel.build(*[rule.name for rule in rules])
+        except subprocess.CalledProcessError as e:
+            logger.warning("Failed to build rules with missing jars: %s", e)
+        # The build created new files.
+        self._reset_jar_lookup()
+        for rule in rules:
+            jar_files = [self._get_jar_file(jar) for jar in rule.jars]
+            if None in jar_files:
+                logger.warning("Unable to find the jars %s of %s", rule.jars, rule.name)
+            rule.jars = [jar for jar in jar_files if jar]
 
     def _scan_classes(self):
-        # Rules that should be skipped
-        RULE_SKIP_LIST = [
-            # Compile time only dependencies, only used for debezium
-            "@debezium_1_7//:compile_time_only_dependencies",
-        ]
-        for rule in self.jvm_libs.values():
-            if rule.name in RULE_SKIP_LIST:
-                logger.info("Skip %s", rule.name)
-                continue
+        rules = self.jvm_libs.values()
+        # Resolve the jars here, then list the classes of every jar in
+        # parallel. Processes rather than threads since zipfile holds
+        # the GIL most of the time. Only the outputs queried by
+        # _resolve_outputs are left to be checked, the rest is memoized.
+        self._prefetch_paths(
+            self._jar_relative_path(jar) for rule in rules
+            for jar in rule.jars if jar.startswith("//") or not os.path.isabs(jar))
+        missing_rules = []
+        for rule in rules:
             logger.info("check %s with %s", rule.name, rule.jars)
+            jar_files = [self._get_jar_file(jar) for jar in rule.jars]
+            if None in jar_files:
+                missing_rules.append(rule)
+            else:
+                rule.jars = jar_files
+        if missing_rules:
+            self._resolve_missing_jars(missing_rules)
+        # Rules often share a jar(like java_import of the same vendored
+        # jar), so each jar is listed only once.
+        jar_classes = dict()
+        jar_files = list(dict.fromkeys(jar for rule in rules for jar in rule.jars))
+        intern = self._class_intern
+        class_names = self._class_names
+        for jar, classes in zip(jar_files, self._list_classes(jar_files)):
+            ids = []
+            for c in classes:
+                i = intern.get(c)
+                if i is None:
+                    i = intern[c] = len(class_names)
+                    class_names.append(c)
+                ids.append(i)
+            jar_classes[jar] = ids
+        for rule in rules:
             for jar in rule.jars:
-                self._record_classes_from_rule(rule, jar)
+                rule.classes.extend(jar_classes[jar])
+
+    def _list_classes(self, jar_files):
+        """Yield the classes of each jar, in the order of jar_files."""
+        if self.jobs == 1 or len(jar_files) <= 1:
+            # Not worth starting worker processes.
+            yield from map(_list_classes_in_jar, jar_files)
+            return
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.jobs) as executor:
+            yield from executor.map(_list_classes_in_jar, jar_files, chunksize=16)
+
+    def to_sqlite(self, output_file):
+        """Write the database as SQLite so lookups don't need to load it."""
+        rule_names = list(self.jvm_libs)
+        class_to_rule = self._class_to_rule()
+        class_names = self._class_names
+        tmp_file = output_file + ".tmp"
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        conn = sqlite3.connect(tmp_file)
+        with conn:
+            conn.execute("PRAGMA user_version = {}".format(DB_VERSION))
+            conn.execute("CREATE TABLE class_to_rule("
+                         "class TEXT PRIMARY KEY, rules TEXT) WITHOUT ROWID")
+            conn.execute("CREATE TABLE alias("
+                         "rule TEXT PRIMARY KEY, alias TEXT) WITHOUT ROWID")
+            conn.execute("CREATE TABLE rules("
+                         "name TEXT PRIMARY KEY, data BLOB) WITHOUT ROWID")
+            conn.executemany(
+                "INSERT INTO class_to_rule VALUES (?, ?)",
+                ((c, json.dumps([rule_names[r] for r in rules]))
+                 for c, rules in class_to_rule.items()))
+            # Same as autodeps, the last alias of a rule wins.
+            conn.executemany(
+                "INSERT OR REPLACE INTO alias VALUES (?, ?)",
+                ((r, a) for a, r in self.alias_map.items()))
+            conn.executemany(
+                "INSERT INTO rules VALUES (?, ?)",
+                ((name, json.dumps(rule.to_list(class_names)))
+                 for name, rule in self.jvm_libs.items()))
+        conn.close()
+        os.replace(tmp_file, output_file)
+
+    def _class_to_rule(self):
+        """Inverted index from a class name to the rules providing it.
+
+        The rules are given by their position in jvm_libs, which is also
+        their position in the names column of the JSON database.
+        """
+        class_to_rule = collections.defaultdict(list)
+        for i, rule in enumerate(self.jvm_libs.values()):
+            for c in rule.classes:
+                class_to_rule[c].append(i)
+        class_names = self._class_names
+        return {class_names[c]: rules for c, rules in class_to_rule.items()}
+
+    def _jvm_libs_columns(self):
+        """Store the rules as one array per field so readers only need
+        to touch the fields they use.
+
+        The classes are left out, they are in the class_to_rule index.
+        """
+        rules = self.jvm_libs.values()
+        return dict(names=[r.name for r in rules],
+                    jars=[r.jars for r in rules],
+                    exports=[r.exports for r in rules],
+                    visibility=[r.visibility for r in rules])
 
     def to_json(self):
-        return json.dumps(
-            dict(alias=self.alias_map,
-                jvm_libs=self.jvm_libs))
+        """Serialize the database to UTF-8 encoded JSON."""
+        return json_dumps(
+            dict(version=DB_VERSION,
+                 alias=self.alias_map,
+                 jvm_libs=self._jvm_libs_columns(),
+                 class_to_rule=self._class_to_rule()))
+
+
+def write_db_file(output_file, content):
+    """Write the database, compressed based on the file extension.
+
+    .zst uses Zstandard, which decompresses several times faster than
+    gzip, anything else is written as gzip. Compressing is often slower
+    than the indexing itself, so gzip uses level 1, with pigz if it is
+    installed.
+    """
+    if output_file.endswith(".zst"):
+        import zstandard
+        with open(output_file, "wb") as fp:
+            with zstandard.ZstdCompressor(level=10).stream_writer(fp) as writer:
+                writer.write(content)
+    elif shutil.which("pigz"):
+        with open(output_file, "wb") as fp:
+            subprocess.run(["pigz", "-1", "-p", str(os.cpu_count() or 1)],
+                           input=content, stdout=fp, check=True)
+    else:
+        with gzip.open(output_file, "wb", compresslevel=1) as fp:
+            fp.write(content)
+
+
+# The part of the Target proto used by DepsParser, everything else is
+# skipped when decoded with msgspec.
+class _Attribute(TypedDict, total=False):
+    name: str
+    stringValue: str
+    stringListValue: list[str]
+
+
+class _Rule(TypedDict, total=False):
+    name: str
+    ruleClass: str
+    attribute: list[_Attribute]
+    ruleOutput: list[str]
+
+
+class _Target(TypedDict, total=False):
+    type: str
+    rule: _Rule
+
+
+class _Record(_Target, total=False):
+    # Set by cquery, query outputs the target itself.
+    target: _Target
+
+
+class _Results(TypedDict, total=False):
+    results: list[_Record]
+
+
+if msgspec is not None:
+    _decode_record = msgspec.json.Decoder(_Record).decode
+    _decode_results = msgspec.json.Decoder(_Results).decode
+else:
+    _decode_record = _decode_results = json_loads
+
+
+def iter_streamed_targets(lines):
+    """Yield the targets from --output=streamed_jsonproto lines."""
+    for line in lines:
+        if line.strip():
+            # Parsed from bytes, no need to decode first.
+            record = _decode_record(line)
+            # cquery wraps the target with its configuration.
+            yield record.get("target", record)
+
+
+# The first key of the dump, "results" for jsonproto(or no key if
+# there are no results), anything else for streamed_jsonproto.
+_FIRST_KEY_RE = re.compile(rb'\s*\{\s*(?:"(\w+)"|\})')
+
+
+def iter_seed_targets(fp):
+    """Yield the targets from a jsonproto or streamed_jsonproto dump.
+
+    The format is told from the start of the file, a jsonproto dump
+    may be on a single line.
+    """
+    m = _FIRST_KEY_RE.match(fp.read(4096))
+    fp.seek(0)
+    if m and m[1] in (None, b"results"):
+        return iter_jsonproto_targets(fp)
+    return iter_streamed_targets(fp)
+
+
+def iter_jsonproto_targets(fp):
+    """Yield the targets from a cquery --output=jsonproto dump.
+
+    With ijson each target is parsed as the file is read, instead of
+    loading the whole dump in memory first.
+    """
+    if ijson is not None:
+        yield from ijson.items(fp, "results.item.target", use_float=True)
+    else:
+        for t in _decode_results(fp.read()).get("results", []):
+            yield t["target"]
 
 
 class Indexer(object):
 
-    def __init__(self, seed_target, seed_file, workspace):
+    def __init__(self, seed_target, seed_file, workspace, jobs=None, use_query=False):
         self.seed_target = seed_target
         self.seed_file = seed_file
+        self.jobs = jobs
+        self.use_query = use_query
         self.bazel = BazelWrapper(workspace)
 
     def bazel_output(self, *args):
@@ -308,25 +883,28 @@ class Indexer(object):
         return subprocess.check_output(command, cwd=self.universe, universal_newlines=True)
 
     def refresh(self, output):
-        dep_parser = DepsParser(self.bazel)
+        dep_parser = DepsParser(self.bazel, self.jobs)
         if self.seed_file:
             logger.info("loading from %s", self.seed_file)
-            with open(os.path.expanduser(self.seed_file), "r") as fp:
-                all_deps = fp.read()
-            dep_parser.parse(all_deps)
+            with open(os.path.expanduser(self.seed_file), "rb") as fp:
+                dep_parser.parse(iter_seed_targets(fp))
         else:
             self.bazel.build(self.seed_target)
-            all_deps = self.bazel.get_deps_tree(self.seed_target)
-            dep_parser.parse(all_deps)
+            dep_parser.parse(self.bazel.get_deps_tree(self.seed_target, self.use_query))
         dep_parser.report()
         output_file = os.path.expanduser(output)
         os.makedirs(os.path.dirname(output_file), exist_ok=True)
-        with gzip.open(output_file, "wt") as fp:
-            fp.write(dep_parser.to_json())
+        if output_file.endswith(".sqlite"):
+            dep_parser.to_sqlite(output_file)
+        else:
+            write_db_file(output_file, dep_parser.to_json())
         logger.info("autodeps database is available in %s", output)
 
 
 def main():
+    # Only needed for the command line, not when used as a library.
+    import argparse
+
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter, description=__doc__
     )
@@ -340,7 +918,7 @@ def main():
         "--seed-file",
         type=str,
         default=None,
-        help="If set, the json file that contains the list of build rule to start from",
+        help="If set, the json file(cquery --output=jsonproto or query --output=streamed_jsonproto) that contains the list of build rule to start from",
     )
     parser.add_argument(
         "--workspace",
@@ -352,10 +930,21 @@ def main():
         "--output",
         type=str,
         default="~/.cache/autodeps/autodeps-db.json.gz",
-        help="File to write generated database file"
+        help="File to write generated database file(.json.gz, .json.zst or .sqlite)"
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of processes used to list the classes of the jars(if unset, number of CPUs)",
+    )
+    parser.add_argument(
+        "--use-query",
+        action="store_true",
+        help="Find the deps of --seed with bazel query instead of cquery, which skips the analysis phase but ignores the attributes set with select()",
     )
     args = parser.parse_args()
-    i = Indexer(args.seed, args.seed_file, args.workspace)
+    i = Indexer(args.seed, args.seed_file, args.workspace, args.jobs, args.use_query)
     i.refresh(args.output)
 
 
@@ -0,0 +1,60 @@
+import os
+import tempfile
+import unittest
+
+import autodeps
+
+
+class GetImportsFromFileTest(unittest.TestCase):
+
+    def imports(self, source):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "Source.java")
+            with open(path, "wb") as fp:
+                fp.write(source)
+            a = autodeps.AutoDeps.__new__(autodeps.AutoDeps)
+            return list(a._get_imports_from_file(path))
+
+    def test_plain(self):
+        self.assertEqual(self.imports(b"package x;\n\nimport com.foo.Bar;\nimport com.foo.Baz\n"),
+                         ["com.foo.Bar", "com.foo.Baz"])
+
+    def test_crlf(self):
+        self.assertEqual(self.imports(b"import com.foo.Bar;\r\nimport com.foo.Baz\r\n"),
+                         ["com.foo.Bar", "com.foo.Baz"])
+
+    def test_static(self):
+        self.assertEqual(self.imports(b"import static com.foo.Bar.baz;\n"
+                                      b"import static com.foo.Qux.*;\n"),
+                         ["com.foo.Bar", "com.foo.Qux"])
+
+    def test_wildcard_package(self):
+        self.assertEqual(self.imports(b"import com.foo.*;\n"), [])
+
+    def test_braces(self):
+        self.assertEqual(self.imports(b"import com.foo.{A, B}\n"), ["com.foo.A", "com.foo.B"])
+
+    def test_braces_multi_line(self):
+        self.assertEqual(self.imports(b"import com.foo.{\n  A,\n  B\n}\nimport com.x.Y\n"),
+                         ["com.foo.A", "com.foo.B", "com.x.Y"])
+
+    def test_trailing_comment(self):
+        self.assertEqual(self.imports(b"import com.foo.Bar; // NOPMD\n"
+                                      b"import com.foo.Baz /* why */\n"),
+                         ["com.foo.Bar", "com.foo.Baz"])
+
+    def test_several_on_one_line(self):
+        self.assertEqual(self.imports(b"import com.foo.A; import com.foo.B;import com.foo.C;\n"),
+                         ["com.foo.A", "com.foo.B", "com.foo.C"])
+
+    def test_not_imports(self):
+        self.assertEqual(self.imports(b"// import com.foo.Commented;\n"
+                                      b"importer.run();\n"
+                                      b"Important i;\n"), [])
+
+    def test_empty_file(self):
+        self.assertEqual(self.imports(b""), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import os
+import tempfile
+import unittest
+import zipfile
+
+import indexer
+
+
+def zipfile_classes(path):
+    """What get_class_names_from_jar is expected to return."""
+    with zipfile.ZipFile(path) as zp:
+        return [n.replace("/", ".").removesuffix(".class")
+                for n in zp.namelist() if n.endswith(".class")]
+
+
+class GetClassNamesFromJarTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def path(self, name):
+        return os.path.join(self.tmp.name, name)
+
+    def make_jar(self, name, entries, comment=b""):
+        path = self.path(name)
+        with zipfile.ZipFile(path, "w") as zp:
+            for entry in entries:
+                zp.writestr(entry, b"\xca\xfe\xba\xbe")
+            zp.comment = comment
+        return path
+
+    def assert_same_as_zipfile(self, path, fast=True):
+        with open(path, "rb") as fp:
+            direct = indexer._read_central_directory_classes(fp.read())
+        self.assertEqual(direct is not None, fast)
+        self.assertEqual(list(indexer.get_class_names_from_jar(path)),
+                         zipfile_classes(path))
+
+    def test_plain(self):
+        path = self.make_jar("plain.jar", [
+            "META-INF/MANIFEST.MF", "com/foo/Bar.class", "com/foo/Bar$Inner.class",
+            "com/foo/res.properties", "com/foo/class", ".class"])
+        self.assert_same_as_zipfile(path)
+        self.assertEqual(list(indexer.get_class_names_from_jar(path)),
+                         ["com.foo.Bar", "com.foo.Bar$Inner", ""])
+
+    def test_prepended_stub(self):
+        jar = self.make_jar("plain.jar", ["com/foo/Bar.class"], comment=b"x" * 100)
+        path = self.path("stub.jar")
+        with open(path, "wb") as fp, open(jar, "rb") as src:
+            fp.write(b"#!/bin/sh\nexec java -jar \"$0\" \"$@\"\n" + src.read())
+        self.assert_same_as_zipfile(path)
+
+    def test_signature_in_comment(self):
+        path = self.make_jar("comment.jar", ["com/foo/Bar.class"],
+                             comment=b"PK\x05\x06" + b"\x00" * 30)
+        self.assertEqual(list(indexer.get_class_names_from_jar(path)), ["com.foo.Bar"])
+
+    def test_zip64(self):
+        # More entries than the EOCD can count.
+        entries = ["com/foo/C{}.class".format(i) for i in range(0x10000)]
+        path = self.make_jar("zip64.jar", entries)
+        self.assert_same_as_zipfile(path, fast=False)
+
+    def test_utf8_names(self):
+        path = self.make_jar("utf8.jar", ["com/é/Ça.class", "日本/X.class"])
+        self.assert_same_as_zipfile(path)
+
+    def test_cp437_names(self):
+        path = self.make_jar("cp437.jar", ["com/XX/A.class", "com/b/B.class"])
+        with open(path, "rb") as fp:
+            data = fp.read()
+        # Without the UTF-8 flag, the name is in the legacy encoding.
+        with open(path, "wb") as fp:
+            fp.write(data.replace(b"com/XX/", b"com/\x82\x87/"))
+        self.assert_same_as_zipfile(path)
+        self.assertEqual(list(indexer.get_class_names_from_jar(path))[0], "com.éç.A")
+
+    def test_cp437_name_with_extra_field(self):
+        path = self.path("extra.jar")
+        with zipfile.ZipFile(path, "w") as zp:
+            info = zipfile.ZipInfo("com/XX/A.class")
+            info.extra = b"\xfe\xca\x00\x00"
+            zp.writestr(info, b"")
+        with open(path, "rb") as fp:
+            data = fp.read()
+        with open(path, "wb") as fp:
+            fp.write(data.replace(b"com/XX/", b"com/\x82\x87/"))
+        # Could carry a unicode path extra field, left to zipfile.
+        self.assert_same_as_zipfile(path, fast=False)
+
+    def test_empty_file(self):
+        path = self.path("empty.jar")
+        open(path, "wb").close()
+        with self.assertRaises(zipfile.BadZipFile):
+            list(indexer.get_class_names_from_jar(path))
+
+
+if __name__ == "__main__":
+    unittest.main()